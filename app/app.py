@@ -6,7 +6,6 @@ monkey.patch_all()
 # ================================================================================
 from flask import Flask, render_template, request, session, jsonify, redirect, url_for
 from flask_socketio import SocketIO, emit
-from flask_session import Session
 from datetime import timedelta
 import os
 import redis
@@ -14,11 +13,15 @@ import time
 import tempfile
 import shutil
 import gevent
+from gevent.pool import Pool, PoolFull
 import gevent.subprocess as subprocess # Crucial for non-blocking subprocesses
 from rq import Queue
 from werkzeug.exceptions import NotFound
 
+from gevent_long_running import long_running_task
 from models import Run
+from progress import ProgressEmitter
+from redis_clients import enable_cancel_keyspace_events, make_cancel_client
 from run_repository import (
     init_db,
     list_runs,
@@ -42,34 +45,58 @@ app.config['SECRET_KEY'] = os.getenv('DCGGSRRJPJ_APP_SECRET_KEY') or 'dev-secret
 
 # --- Redis & Session Configuration ---
 redis_host = os.getenv('REDIS_HOST', 'redis')
-# Session Redis client (DB 1)
-app.config['SESSION_TYPE'] = 'redis'
-app.config['SESSION_REDIS'] = redis.StrictRedis(host=redis_host, port=6379, db=1)
-app.config['SESSION_PERMANENT'] = True
-app.config['SESSION_USE_SIGNER'] = True
+# Sessions use Flask's default signed cookie. The only field stored is the
+# Socket.IO SID, so a server-side store would just add Redis round trips to
+# every HTTP request.
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=72)
-Session(app)
 
 # Cancellation Redis client (DB 3)
-# decode_responses=True makes it easier to work with keys and values as strings
-redis_cancel_client = redis.StrictRedis(host=redis_host, port=6379, db=3, decode_responses=True)
+redis_cancel_client = make_cancel_client(redis_host)
+# Setting a cancel flag notifies subscribers directly; no separate PUBLISH.
+cancel_keyspace_events = enable_cancel_keyspace_events(redis_cancel_client)
 CANCELATION_TOKEN_LIFETIME = 600  # seconds
 
 # --- Socket.IO Initialization ---
+# Per-packet Socket.IO/Engine.IO logging is costly with many clients; set
+# SOCKETIO_DEBUG=1 to turn it back on while debugging.
+socketio_debug = os.getenv("SOCKETIO_DEBUG") == "1"
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     async_mode="gevent",
     channel='flask-socketio',
     message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE", "redis://redis:6379/2"),
-    logger=True,
-    engineio_logger=True
+    logger=socketio_debug,
+    engineio_logger=socketio_debug
 )
 
 # --- RQ Queue Configuration ---
 rq_redis_url = os.getenv('RQ_REDIS_URL') or os.getenv('REDIS_URL') or f'redis://{redis_host}:6379/0'
 task_queue = Queue('default', connection=redis.Redis.from_url(rq_redis_url), default_timeout=3600)
 
+# --- In-process Task Pool ---
+# Bounds how many gevent background tasks (Methods 1 and 2) run at once in this
+# worker, so a burst of start requests cannot fork an unbounded number of
+# subprocesses.
+task_pool = Pool(size=int(os.getenv("MAX_CONCURRENT_TASKS", "4")))
+
+
+def _reserve_task(sid, total_iterations):
+    """
+    Claims a task_pool slot for a new long_running_task, or returns None if
+    every slot is taken.
+
+    Nothing here yields, so concurrent requests cannot all see a free slot
+    and then block in spawn(). The caller starts the returned greenlet once
+    its own setup is done, or discards it from task_pool if that fails.
+    """
+    greenlet = gevent.Greenlet(long_running_task, sid, total_iterations)
+    try:
+        task_pool.add(greenlet, blocking=False)
+    except PoolFull:
+        return None
+    return greenlet
+
 # Ensure the Run storage is ready before handling requests
 init_db()
 
@@ -152,8 +179,6 @@ def update_run_name(run_enum: int):
 @socketio.on('start_task')
 def handle_start_task(data):
     """Starts the task for the requesting client."""
-    from gevent_long_running import long_running_task
-
     sid = request.sid
     run_enum = None
     if isinstance(data, dict):
@@ -174,15 +199,23 @@ def handle_start_task(data):
         emit('task_error', {'message': 'Configured total_iterations must be a positive integer.'})
         return
 
-    redis_cancel_client.delete(f"cancel_{sid}") # Clear any old cancellation flags
-    emit('task_started', {'status': 'Your background task has been initiated.'})
-    socketio.start_background_task(long_running_task, sid, run.total_iterations)
+    task = _reserve_task(sid, run.total_iterations)
+    if task is None:
+        emit('task_error', {'message': 'The server is busy running other tasks. Please try again later.'})
+        return
+
+    try:
+        redis_cancel_client.delete(f"cancel_{sid}") # Clear any old cancellation flags
+        emit('task_started', {'status': 'Your background task has been initiated.'})
+    except BaseException:
+        task_pool.discard(task)
+        raise
+    task.start()
 
 # --- Method 2: Start task via non-blocking HTTP request ---
 @app.route('/runs/<int:run_enum>/start-task2')
 def start_long_task2(run_enum: int):
     """Starts the task by getting the SID from the request args."""
-    from gevent_long_running import long_running_task
     sid = request.args.get('sid')
     if not sid:
         return jsonify({"message": "Error: SID is required."}), 400
@@ -194,10 +227,20 @@ def start_long_task2(run_enum: int):
     if run.total_iterations <= 0:
         return jsonify({"message": "Configured total_iterations must be a positive integer."}), 400
 
+    task = _reserve_task(sid, run.total_iterations)
+    if task is None:
+        message = "The server is busy running other tasks. Please try again later."
+        socketio.emit('task_error', {'message': message}, to=sid)
+        return jsonify({"message": message}), 503
+
     print(f"Received HTTP request for /runs/{run_enum}/start-task2 for SID: {sid}")
-    redis_cancel_client.delete(f"cancel_{sid}") # Clear any old cancellation flags
-    socketio.emit('task_started', {'status': 'Your background task has been initiated.'}, to=sid)
-    socketio.start_background_task(long_running_task, sid, run.total_iterations)
+    try:
+        redis_cancel_client.delete(f"cancel_{sid}") # Clear any old cancellation flags
+        socketio.emit('task_started', {'status': 'Your background task has been initiated.'}, to=sid)
+    except BaseException:
+        task_pool.discard(task)
+        raise
+    task.start()
     return jsonify({"message": "Your long-running task has been started via HTTP."})
 
 
@@ -205,17 +248,20 @@ def start_long_task2(run_enum: int):
 @app.route('/runs/<int:run_enum>/start-task3')
 def start_long_task3(run_enum: int):
     """
-    Starts a long-running, INTENTIONALLY BLOCKING task directly within the HTTP
-    request-response cycle. 
-    
-    This demonstrates why this approach is detrimental in a production server, 
-    as it will make the server worker that handles this request completely 
-    unresponsive to any other requests until the entire task is finished.
+    Runs a long-running task directly within the HTTP request-response cycle.
+
+    This demonstrates why this approach is a poor fit for a production server:
+    the request does not return until every iteration has finished, so the
+    client's HTTP call is tied up for the whole task and its commands run
+    strictly one after another. gevent's subprocess yields while waiting on
+    each child, so the worker itself keeps serving other requests, Socket.IO
+    traffic and `/cancel-task` meanwhile; the cancel flag is honoured between
+    iterations.
+
+    The blocking demo only runs when ALLOW_BLOCKING_DEMO=1. Otherwise the task
+    is handed to the RQ worker, exactly like Method 4, so a stray request
+    cannot stall the worker and drop every Socket.IO client's heartbeat.
     """
-    import subprocess # Use the standard blocking subprocess module
-    import tempfile
-    import shutil
-
     sid = request.args.get('sid')
     if not sid:
         return jsonify({"message": "Error: SID is required for this test."}), 400
@@ -227,51 +273,62 @@ def start_long_task3(run_enum: int):
     if run.total_iterations <= 0:
         return jsonify({"message": "Configured total_iterations must be a positive integer."}), 400
 
-    print(f"🛑 Starting INTENTIONALLY BLOCKING task for SID: {sid}")
-    print("   This server worker will be UNRESPONSIVE to other HTTP requests until this completes.")
+    if os.getenv("ALLOW_BLOCKING_DEMO") != "1":
+        print(f"Blocking demo disabled; queueing /start-task3 for SID: {sid} on RQ")
+        redis_cancel_client.delete(f"cancel_{sid}")
+        socketio.emit('task_started', {'status': 'Blocking demo is disabled; your task has been queued.'}, to=sid)
+        job = task_queue.enqueue('rq_long_running.long_running_task', sid, run.total_iterations, job_timeout=3600)
+        return jsonify({"message": "Blocking demo is disabled; your task has been queued via RQ.", "job_id": job.id})
 
-    # While the worker is blocked, emitting a message may still work if you are
-    # using a message queue like Redis, as it just hands the message off.
-    # However, the worker itself cannot do any other processing.
+    print(f"🛑 Starting request-bound task for SID: {sid}")
+    print("   This HTTP request will not return until the task completes; the worker keeps serving others.")
+
+    # Progress goes out over Socket.IO while the HTTP response is still pending.
+    redis_cancel_client.delete(f"cancel_{sid}") # Clear any old cancellation flags
     socketio.emit('task_started', {'status': 'Your blocking task has started.'}, to=sid)
 
     temp_dir = tempfile.mkdtemp(prefix="blocking-task-")
     total_iterations = run.total_iterations
+    progress = ProgressEmitter(socketio, sid)
+
+    # The commands are the same every iteration. dd overwrites the same file
+    # each time; the final rmtree removes it.
+    cpu_command = [
+        "openssl", "speed", "-evp", "aes-256-cbc", 
+        "-multi", "10", # Use 10 cores for this process
+    ]
+    disk_output_file = os.path.join(temp_dir, "temp_disk.bin")
+    disk_command = [
+        "dd", "if=/dev/zero", f"of={disk_output_file}",
+        "bs=1M", "count=1024",
+        "oflag=direct",
+    ]
 
     try:
         for i in range(1, total_iterations + 1):
             print(f"  [Blocking] Iteration {i}/{total_iterations} for SID: {sid}")
 
-            # Define the commands for the current iteration
-            cpu_command = [
-                "openssl", "speed", "-evp", "aes-256-cbc", 
-                "-multi", "10", # Use 10 cores for this process
-            ]
-            disk_output_file = os.path.join(temp_dir, f"temp_disk_iter_{i}.bin")
-            disk_command = [
-                "dd", "if=/dev/zero", f"of={disk_output_file}",
-                "bs=1M", "count=1024",
-                "oflag=direct",
-            ]
-
-            # --- THE BLOCKING CALLS ---
-            # Each subprocess.run() call halts all execution in this worker
-            # until the external command finishes. They run one after the other.
-            print(f"    -> Running BLOCKING CPU task...")
-            subprocess.run(cpu_command, capture_output=True, check=False)
-            
-            print(f"    -> Running BLOCKING Disk task...")
-            subprocess.run(disk_command, capture_output=True, check=False)
-            
-            # Clean up the file for this iteration
-            os.remove(disk_output_file)
-
-            # NOTE: Cancellation checks are pointless here. Because this worker is
-            # completely blocked, it could never process an incoming HTTP
-            # request to the `/cancel-task` route in the first place.
-
-            percent_complete = int((i / total_iterations) * 100)
-            socketio.emit('task_progress', {'percent': percent_complete}, to=sid)
+            # --- THE SERIAL CALLS ---
+            # Each subprocess.run() call holds this request until the external
+            # command finishes, and they run one after the other. gevent's
+            # subprocess yields while waiting on the child, so only this
+            # request waits, not the worker. Output is discarded rather than
+            # buffered in memory.
+            print(f"    -> Running CPU task...")
+            subprocess.run(cpu_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+            print(f"    -> Running Disk task...")
+            subprocess.run(disk_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+            # `/cancel-task` is served while this request waits, so honour its
+            # flag between iterations.
+            if redis_cancel_client.exists(f"cancel_{sid}"):
+                print(f"  [Blocking] Cancelled by user for SID: {sid}")
+                socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
+                return jsonify({"message": f"The blocking task was cancelled after {i} of {total_iterations} iterations."})
+
+            percent_complete = i * 100 // total_iterations
+            progress.maybe_emit(percent_complete)
             print(f"  [Blocking] Progress: {percent_complete}%")
 
     except Exception as e:
@@ -339,6 +396,7 @@ def cancel_task_http():
 @socketio.on('connect')
 def handle_connect():
     """Handles a new client connection."""
+    session.permanent = True
     session['socket_sid'] = request.sid
     print(f"✅ Client connected: {request.sid}. Stored in Flask session.")
     emit('server_welcome', {'message': f'Welcome! Your SID {request.sid} has been stored.'})
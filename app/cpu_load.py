@@ -0,0 +1,19 @@
+"""CPU workload helpers shared by the gevent and RQ task variants."""
+
+# Seconds of `openssl speed` load that each iteration accounts for. This
+# matches the old per-iteration run, which timed 6 block sizes for 3 s each.
+CPU_SECONDS_PER_ITERATION = 18
+
+# A single block size, so `-seconds` is the length of the whole run rather
+# than of each of the default block sizes.
+_BLOCK_BYTES = 16384
+
+
+def cpu_command(total_iterations):
+    """Returns the `openssl speed` command that loads the CPU for a whole task."""
+    return [
+        "openssl", "speed", "-evp", "aes-256-cbc",
+        "-multi", "10", # Use 10 cores for this process
+        "-bytes", str(_BLOCK_BYTES),
+        "-seconds", str(CPU_SECONDS_PER_ITERATION * total_iterations),
+    ]
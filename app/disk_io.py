@@ -0,0 +1,78 @@
+"""Disk workload helpers shared by the gevent and RQ task variants."""
+
+import errno
+import os
+from contextlib import contextmanager
+
+# Size of the file written by each task iteration.
+DISK_TASK_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
+# Set DISK_TASK_USE_DD=1 to write the file with `dd if=/dev/zero` instead of
+# preallocating it, e.g. to benchmark the old behaviour.
+USE_DD = os.getenv("DISK_TASK_USE_DD") == "1"
+
+_O_DIRECT = getattr(os, "O_DIRECT", 0)
+_O_TMPFILE = getattr(os, "O_TMPFILE", 0)
+
+# Used when the kernel or filesystem has no O_TMPFILE support. It is reused
+# (truncated) by every iteration and removed with the task's temp dir.
+_FALLBACK_NAME = "scratch.bin"
+
+
+def _open_direct(path, flags):
+    try:
+        return os.open(path, flags | _O_DIRECT, 0o600)
+    except OSError as e:
+        # Some filesystems (e.g. tmpfs) reject O_DIRECT.
+        if e.errno != errno.EINVAL or not _O_DIRECT:
+            raise
+        return os.open(path, flags, 0o600)
+
+
+@contextmanager
+def scratch_file(directory):
+    """
+    Yields a write-only file descriptor for one iteration's disk file.
+
+    The file is created with O_TMPFILE, so it never has a name: it disappears
+    when the descriptor is closed, even if the process is killed, and nothing
+    has to be unlinked afterwards.
+    """
+    fd = None
+    if _O_TMPFILE:
+        try:
+            fd = _open_direct(directory, _O_TMPFILE | os.O_WRONLY)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                raise
+    if fd is None:
+        path = os.path.join(directory, _FALLBACK_NAME)
+        fd = _open_direct(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def dd_command(fd):
+    """Returns the `dd` command that writes DISK_TASK_BYTES of zeros to `fd`."""
+    # The child opens our descriptor through /proc, which also works for an
+    # O_TMPFILE file that has no name on disk.
+    return [
+        "dd", "if=/dev/zero", f"of=/proc/{os.getpid()}/fd/{fd}",
+        "bs=1M", f"count={DISK_TASK_BYTES // (1024 * 1024)}",
+        "oflag=direct", # Bypass OS cache for more realistic disk I/O
+    ]
+
+
+def allocate_file(fd, size=DISK_TASK_BYTES):
+    """
+    Allocates `size` bytes of zero-filled extents in `fd` with a single
+    posix_fallocate() call, without streaming data through memory.
+
+    Returns:
+        int: 0, mirroring the exit code of the `dd` command it replaces.
+    """
+    os.posix_fallocate(fd, 0, size)
+    return 0
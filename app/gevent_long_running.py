@@ -1,34 +1,182 @@
-"""RQ task definitions for long-running operations with cancellation support."""
+"""gevent task definitions for long-running operations with cancellation support."""
 
 from __future__ import annotations
 
 import os
 import shutil
-import subprocess
+import signal
 import tempfile
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Iterable, List, Union
 
-from redis import Redis
 import gevent
 import gevent.subprocess as subprocess
+from gevent.event import Event
 
+import cpu_load
+import disk_io
+from progress import ProgressEmitter
+from redis_clients import CANCEL_KEYSPACE_PATTERN, enable_cancel_keyspace_events
 
 
-REDIS_URL = os.getenv("RQ_REDIS_URL") or os.getenv("REDIS_URL") or "redis://redis:6379/0"
-redis_connection = Redis.from_url(REDIS_URL)
+class CancelRegistry:
+    """
+    Process-wide watcher for task cancellation flags.
+
+    Each running task registers its SID and gets back a gevent Event that is
+    set once the task is cancelled. A single greenlet serves every task in the
+    process: it subscribes to the keyspace notifications for the `cancel_*`
+    keys, so the `SET` issued by the cancel handlers is pushed straight to it.
+    Notifications are only delivered while subscribed, so flags set before a
+    task registered, or while the subscription was down, are picked up by a
+    one-off check instead: `register()` checks its own flag once the watcher
+    is subscribed, and every (re)subscription sweeps all registered flags.
+    Redis forgets the notification setting on restart and anyone can turn it
+    off, so it is re-applied on every (re)subscription, and a sweep every
+    `backstop_interval` seconds catches flags whose notification never came.
+
+    If the server would not enable keyspace notifications, it instead checks
+    all registered flags with one MGET every `interval` seconds, which is
+    still O(1) Redis commands per tick no matter how many tasks are running.
+    """
+
+    def __init__(self, interval=0.25, ready_timeout=5.0, backstop_interval=5.0):
+        self.interval = interval
+        self.ready_timeout = ready_timeout
+        self.backstop_interval = backstop_interval
+        self._events = {}  # sid -> set of Events, one per running task
+        self._keys = {}    # sid -> cancellation key
+        self._watcher = None
+        self._ready = Event()  # set once the watcher is subscribed or polling
+
+    def register(self, sid):
+        """Starts watching `sid` and returns the Event to wait on."""
+        from app import redis_cancel_client
+
+        event = Event()
+        self._events.setdefault(sid, set()).add(event)
+        self._keys[sid] = key = f"cancel_{sid}"
+        if self._watcher is None:
+            self._watcher = gevent.spawn(self._watch)
+
+        # A flag set before the watcher was listening produced no
+        # notification, so look for it once.
+        try:
+            self._ready.wait(timeout=self.ready_timeout)
+            if redis_cancel_client.exists(key):
+                event.set()
+        except Exception as e:
+            print(f"  [!!!] Cancel registry error checking {key}: {e}")
+        except BaseException:
+            # e.g. the task was killed while waiting; the caller never gets
+            # the event, so it cannot unregister it.
+            self.unregister(sid, event)
+            raise
+        return event
+
+    def unregister(self, sid, event):
+        """Stops watching `sid` on behalf of the task that owns `event`."""
+        events = self._events.get(sid)
+        if events is None:
+            return
+        events.discard(event)
+        if not events:
+            del self._events[sid]
+            del self._keys[sid]
+
+    def _cancel(self, sid):
+        for event in self._events.get(sid, ()):
+            event.set()
+
+    def _sweep(self, redis_cancel_client):
+        """Checks every registered flag with a single MGET."""
+        if not self._keys:
+            return
+        sids = list(self._keys)
+        values = redis_cancel_client.mget([self._keys[sid] for sid in sids])
+        for sid, value in zip(sids, values):
+            if value:
+                self._cancel(sid)
+
+    def _watch(self):
+        from app import cancel_keyspace_events, redis_cancel_client
 
-CancelResult = Union[str, int]
+        if cancel_keyspace_events:
+            self._listen(redis_cancel_client)
+        else:
+            self._ready.set()
+            self._poll(redis_cancel_client)
 
-def _run_subprocess_with_cancel_check(sid, command):
+    def _listen(self, redis_cancel_client):
+        # Channels look like `__keyspace@3__:cancel_<sid>`.
+        prefix = CANCEL_KEYSPACE_PATTERN[:-1]
+        while True:
+            pubsub = redis_cancel_client.pubsub()
+            try:
+                enable_cancel_keyspace_events(redis_cancel_client)
+                pubsub.psubscribe(CANCEL_KEYSPACE_PATTERN)
+                # Wait for the server to confirm, so no SET after the sweep
+                # below can be missed.
+                while True:
+                    message = pubsub.get_message(timeout=5.0)
+                    if message is not None and message['type'] == 'psubscribe':
+                        break
+                self._sweep(redis_cancel_client)
+                self._ready.set()
+
+                next_sweep = time.monotonic() + self.backstop_interval
+                while True:
+                    message = pubsub.get_message(timeout=self.backstop_interval)
+                    if time.monotonic() >= next_sweep:
+                        self._sweep(redis_cancel_client)
+                        next_sweep = time.monotonic() + self.backstop_interval
+                    if message is None or message['type'] != 'pmessage':
+                        continue
+                    channel, operation = message['channel'], message['data']
+                    if isinstance(channel, bytes):
+                        channel, operation = channel.decode(), operation.decode()
+                    # `expired` and `del` just clear the flag; only `set` cancels.
+                    if operation == 'set':
+                        self._cancel(channel[len(prefix):])
+            except Exception as e:
+                # Resubscribe on a fresh connection; the sweep then catches
+                # any cancellation sent while we were disconnected.
+                print(f"  [!!!] Cancel registry error: {e}")
+                gevent.sleep(self.interval)
+            finally:
+                pubsub.close()
+
+    def _poll(self, redis_cancel_client):
+        while True:
+            try:
+                gevent.sleep(self.interval)
+                self._sweep(redis_cancel_client)
+            except Exception as e:
+                print(f"  [!!!] Cancel registry error: {e}")
+                gevent.sleep(self.interval)
+
+
+cancel_registry = CancelRegistry()
+
+
+def _signal_process_group(proc, sig):
+    """Signals `proc` and any workers it forked, e.g. `openssl speed -multi`."""
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _run_subprocess_with_cancel_check(sid, command, cancel_event, cancel_key):
     """
-    Runs a command in a gevent-friendly subprocess and polls for a Redis 
-    cancellation key. This function is designed to be run within a gevent Greenlet.
+    Runs a command in a gevent-friendly subprocess and terminates it if the
+    task's cancellation Event fires. This function is designed to be run within
+    a gevent Greenlet; killing the Greenlet also kills the subprocess.
 
     Args:
         sid (str): The Socket.IO session ID, used to check for a cancellation flag.
         command (list): The command and its arguments to execute.
+        cancel_event (gevent.event.Event): The task's Event from `cancel_registry`.
+        cancel_key (bytes): The pre-encoded `cancel_{sid}` key.
 
     Returns:
         str: 'cancelled' if the task was cancelled, otherwise the process's exit code.
@@ -36,44 +184,72 @@ def _run_subprocess_with_cancel_check(sid, command):
 
     from app import redis_cancel_client, socketio
 
-    cancel_key = f"cancel_{sid}"
     proc = None
     try:
-        # Use gevent's Popen for non-blocking subprocess management.
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        while proc.poll() is None:
-            # Check for the cancellation signal in Redis.
-            if redis_cancel_client.get(cancel_key):
-                print(f"  [!] Subprocess monitor for SID {sid} found cancel signal. Terminating PID {proc.pid}.")
-                proc.terminate()  # Send SIGTERM to the process.
-                gevent.sleep(0.5) # Give it a moment to terminate gracefully.
-                if proc.poll() is None:
+        if not cancel_event.is_set():
+            # Use gevent's Popen for non-blocking subprocess management. Output
+            # is discarded; an unread pipe could fill and stall the child. The
+            # new session lets us signal the whole process group.
+            proc = subprocess.Popen(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            waiter = gevent.spawn(proc.wait)
+
+            # Block until the process exits or the task is cancelled; nothing
+            # wakes this greenlet in between.
+            gevent.wait([waiter, cancel_event], count=1)
+
+            if not cancel_event.is_set():
+                # Process finished on its own.
+                return proc.returncode
+
+            if proc.poll() is None:
+                print(f"  [!] Subprocess monitor for SID {sid} received cancel signal. Terminating PID {proc.pid}.")
+                _signal_process_group(proc, signal.SIGTERM)
+                try:
+                    proc.wait(timeout=0.5) # Give it a moment to terminate gracefully.
+                except subprocess.TimeoutExpired:
                     print(f"  [!] Process {proc.pid} did not terminate, sending SIGKILL.")
-                    proc.kill() # Force kill if it's still running.
+                    _signal_process_group(proc, signal.SIGKILL) # Force kill if it's still running.
 
-                # The first greenlet to see the cancel signal handles the notification and cleanup.
-                socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
-                redis_cancel_client.delete(cancel_key)
-                return 'cancelled'
-            
-            # Cooperatively yield control to the gevent event loop. This is critical.
-            gevent.sleep(0.2)
-        
-        # Process finished on its own.
-        return proc.returncode
+        # The first greenlet to clear the flag handles the notification.
+        if redis_cancel_client.delete(cancel_key):
+            socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
+        return 'cancelled'
 
+    except gevent.GreenletExit:
+        # The task no longer needs this process (e.g. the CPU stage outlived
+        # the iterations).
+        if proc and proc.poll() is None:
+            _signal_process_group(proc, signal.SIGKILL)
+        raise
     except Exception as e:
         print(f"  [!!!] Error running subprocess for SID {sid} with command '{' '.join(command)}': {e}")
         if proc and proc.poll() is None:
-            proc.kill() # Ensure the process is killed on an unexpected error.
+            _signal_process_group(proc, signal.SIGKILL) # Ensure the process is killed on an unexpected error.
+        return f'error: {e}'
+
+
+def _allocate_disk_file(sid, fd):
+    """
+    Preallocates the iteration's disk file on gevent's native threadpool so the
+    fallocate() syscall does not block the event loop.
+
+    Returns:
+        int | str: 0 on success, otherwise an 'error: ...' string.
+    """
+    try:
+        return gevent.get_hub().threadpool.apply(disk_io.allocate_file, (fd,))
+    except OSError as e:
+        print(f"  [!!!] Error allocating disk file for SID {sid}: {e}")
         return f'error: {e}'
 
 
 def long_running_task(sid, total_iterations):
     """
-    A non-trivial long-running task that spawns concurrent CPU-bound and
-    Disk I/O-bound subprocesses in a loop, with cancellation support.
+    A non-trivial long-running task that runs a CPU-bound subprocess for the
+    whole task alongside per-iteration Disk I/O, with cancellation support.
     """
 
     from app import redis_cancel_client, socketio
@@ -82,72 +258,85 @@ def long_running_task(sid, total_iterations):
         raise ValueError("total_iterations must be at least 1")
 
     print(f"Task started for SID: {sid}")
-    cancel_key = f"cancel_{sid}"
-    # Create a temporary directory for this task's output files.
-    temp_dir = tempfile.mkdtemp(prefix="gevent-task-")
-    print(f"  Created temp dir for SID {sid}: {temp_dir}")
-
-    socketio.emit('task_progress', {'percent': 0.0}, to=sid)
-    
+    # Encoded once so the hot paths don't rebuild the key on every check.
+    cancel_key = f"cancel_{sid}".encode()
+    # Created inside the try below; the cleanup skips whatever is still None.
+    temp_dir = None
+    cancel_event = None
+    cpu_greenlet = None
     try:
+        # Create a temporary directory for this task's output files.
+        temp_dir = tempfile.mkdtemp(prefix="gevent-task-")
+        print(f"  Created temp dir for SID {sid}: {temp_dir}")
+
+        progress = ProgressEmitter(socketio, sid)
+        progress.maybe_emit(0)
+
+        # --- 1. Start the CPU Stage Once for the Whole Task ---
+        # A single long `openssl speed` run replaces one fork-heavy run per
+        # iteration; iterations are paced against its elapsed time instead.
+        cpu_command = cpu_load.cpu_command(total_iterations)
+
+        # Set by the process-wide cancel registry once this task is cancelled.
+        cancel_event = cancel_registry.register(sid)
+        cpu_started = time.monotonic()
+        cpu_greenlet = gevent.spawn(_run_subprocess_with_cancel_check, sid, cpu_command, cancel_event, cancel_key)
+
         for i in range(1, total_iterations + 1):
-            # --- 1. Pre-iteration Cancellation Check ---
-            if redis_cancel_client.get(cancel_key):
+            # --- 2. Pre-iteration Cancellation Check ---
+            if cancel_event.is_set():
                 print(f"  [!] Cancellation signal received for SID: {sid} before iteration {i}. Stopping.")
-                socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
-                redis_cancel_client.delete(cancel_key)
-                return
+                break
 
             print(f"  Starting iteration {i}/{total_iterations} for SID: {sid}")
 
-            # --- 2. Define Subprocess Commands ---
-            cpu_command = [
-                "openssl", "speed", "-evp", "aes-256-cbc", 
-                "-multi", "10", # Use 10 cores for this process
-            ]
-
-            disk_output_file = os.path.join(temp_dir, f"temp_disk_file_iter_{i}.bin")
-            disk_command = [
-                "dd", "if=/dev/zero", f"of={disk_output_file}",
-                "bs=1M", "count=1024", # Write 1024MB per iteration
-                "oflag=direct", # Bypass OS cache for more realistic disk I/O
-            ]
-
-            # --- 3. Spawn Concurrent Subprocesses using gevent ---
-            cpu_greenlet = gevent.spawn(_run_subprocess_with_cancel_check, sid, cpu_command)
-            disk_greenlet = gevent.spawn(_run_subprocess_with_cancel_check, sid, disk_command)
-
-            # --- 4. Wait for Both to Complete ---
-            # gevent.joinall waits for both greenlets to finish their execution.
-            gevent.joinall([cpu_greenlet, disk_greenlet])
-
-            # --- 5. Check Results for Cancellation ---
-            if cpu_greenlet.value == 'cancelled' or disk_greenlet.value == 'cancelled':
+            # --- 3. Run This Iteration's Disk Work ---
+            # The disk file is anonymous and vanishes when closed, so there is
+            # nothing to remove afterwards.
+            with disk_io.scratch_file(temp_dir) as disk_fd:
+                if disk_io.USE_DD:
+                    disk_command = disk_io.dd_command(disk_fd)
+                    disk_greenlet = gevent.spawn(_run_subprocess_with_cancel_check, sid, disk_command, cancel_event, cancel_key)
+                else:
+                    disk_greenlet = gevent.spawn(_allocate_disk_file, sid, disk_fd)
+                disk_greenlet.join()
+
+            # --- 4. Keep Pace with the CPU Stage ---
+            # Wait until the CPU stage has run for this iteration's share of
+            # time, unless it finishes early or the task is cancelled.
+            remaining = cpu_started + i * cpu_load.CPU_SECONDS_PER_ITERATION - time.monotonic()
+            if remaining > 0:
+                gevent.wait([cpu_greenlet, cancel_event], timeout=remaining, count=1)
+
+            if cancel_event.is_set():
                 print(f"  Confirmed cancellation during iteration {i} for SID: {sid}. Exiting loop.")
-                break # Exit the for loop; the helper already sent the notification.
+                break
 
-            print(f"  Finished iteration {i}. CPU task exit code: {cpu_greenlet.value}, Disk task exit code: {disk_greenlet.value}")
-            
-            # --- 6. Clean Up This Iteration's File ---
-            try:
-                os.remove(disk_output_file)
-            except OSError as e:
-                print(f"  Warning: Could not remove temp file {disk_output_file}: {e}")
+            print(f"  Finished iteration {i}. Disk task exit code: {disk_greenlet.value}")
 
-            # --- 7. Report Progress ---
-            percent_complete = int((i / total_iterations) * 100)
-            socketio.emit('task_progress', {'percent': percent_complete}, to=sid)
+            # --- 5. Report Progress ---
+            percent_complete = i * 100 // total_iterations
+            progress.maybe_emit(percent_complete)
             print(f"  ... progress {percent_complete}% for SID: {sid}")
 
-        # If the loop finished without being cancelled, send the final 'finished' event.
-        if not redis_cancel_client.get(cancel_key):
+        if cancel_event.is_set():
+            # The first to clear the flag reports it; a subprocess monitor may
+            # already have done so.
+            if redis_cancel_client.delete(cancel_key):
+                socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
+        else:
             socketio.emit('task_finished', {'status': f'Task completed all {total_iterations} iterations.'}, to=sid)
             print(f"Task finished normally for SID: {sid}")
 
     finally:
         # --- Final Cleanup ---
-        # This block ensures the temporary directory is removed regardless of how the task exits.
-        print(f"  Cleaning up temp dir: {temp_dir}")
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        # This block ensures the CPU stage is stopped and the temporary
+        # directory is removed regardless of how the task exits.
+        if cpu_greenlet is not None:
+            cpu_greenlet.kill()
+        if temp_dir is not None:
+            print(f"  Cleaning up temp dir: {temp_dir}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if cancel_event is not None:
+            cancel_registry.unregister(sid, cancel_event)
         redis_cancel_client.delete(cancel_key) # Final cleanup of the cancellation key.
-
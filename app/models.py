@@ -1,9 +1,9 @@
-from dataclasses import dataclass
-from typing import Optional
+from typing import NamedTuple, Optional
 
 
-@dataclass
-class Run:
+class Run(NamedTuple):
+    """A saved run. Immutable, so the repository can cache and share instances."""
+
     run_enum: Optional[int] = None
     total_iterations: int = 50
     run_name: str = ""
@@ -0,0 +1,43 @@
+"""Progress reporting helpers shared by the web app and the RQ worker."""
+
+import time
+
+
+class ProgressEmitter:
+    """
+    Coalesces 'task_progress' events for a single client.
+
+    A progress event is only published when the integer percentage changes and
+    at least `min_interval` seconds have passed since the last one, so tight
+    loops do not turn into a stream of Redis publishes. 0% and 100% are always
+    sent so the client sees the start and the end of the task.
+
+    Works with anything exposing `emit(event, data, to=...)`, such as
+    Flask-SocketIO's `SocketIO` or python-socketio's `RedisManager`.
+    """
+
+    def __init__(self, socketio, sid, min_interval=0.1):
+        self.socketio = socketio
+        self.sid = sid
+        self.min_interval = min_interval
+        self.last_percent = None
+        self.last_ts = 0.0
+
+    def maybe_emit(self, percent):
+        """Emits the progress if it changed and the rate limit allows it.
+
+        Returns:
+            bool: True if an event was published.
+        """
+        percent = int(percent)
+        if percent == self.last_percent:
+            return False
+
+        now = time.monotonic()
+        if percent not in (0, 100) and now - self.last_ts <= self.min_interval:
+            return False
+
+        self.socketio.emit('task_progress', {'percent': percent}, to=self.sid)
+        self.last_percent = percent
+        self.last_ts = now
+        return True
@@ -0,0 +1,69 @@
+"""Redis client factories shared by the web app and the RQ worker."""
+
+import os
+import socket
+
+import redis
+
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+
+# Database holding the `cancel_{sid}` flags.
+CANCEL_DB = 3
+
+# Keyspace notification channel pattern for the cancellation flags.
+CANCEL_KEYSPACE_PATTERN = f'__keyspace@{CANCEL_DB}__:cancel_*'
+
+# Probe idle connections so a half-open connection (e.g. a dropped NAT entry)
+# is detected in about a minute instead of hanging a greenlet.
+_KEEPALIVE_OPTIONS = {
+    option: value
+    for option, value in (
+        (getattr(socket, 'TCP_KEEPIDLE', None), 30),
+        (getattr(socket, 'TCP_KEEPINTVL', None), 10),
+        (getattr(socket, 'TCP_KEEPCNT', None), 3),
+    )
+    if option is not None
+}
+
+
+def make_cancel_client(host=None):
+    """
+    Returns a client for the task cancellation flags (CANCEL_DB).
+
+    Hundreds of greenlets may share it, so the pool is large, idle sockets are
+    kept alive and health-checked, and a stalled command fails fast.
+    """
+    return redis.Redis(
+        host=host or REDIS_HOST, port=6379, db=CANCEL_DB,
+        decode_responses=True,
+        socket_keepalive=True,
+        socket_keepalive_options=_KEEPALIVE_OPTIONS,
+        health_check_interval=30,
+        max_connections=256,
+        socket_timeout=2,
+    )
+
+
+def enable_cancel_keyspace_events(client):
+    """
+    Turns on keyspace notifications for string commands and expirations
+    (`K$x`), so setting a cancel flag is itself pushed to subscribers.
+
+    The setting is server-wide, so flags already enabled for other clients
+    are kept and only the missing ones are added.
+
+    Returns:
+        bool: False if the server refused (e.g. CONFIG is disabled on a
+        managed Redis); callers should fall back to polling.
+    """
+    try:
+        current = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        # `A` is an alias for every event class, including `$` and `x`.
+        provided = set(current) | (set('$x') if 'A' in current else set())
+        missing = ''.join(flag for flag in 'K$x' if flag not in provided)
+        if missing:
+            client.config_set('notify-keyspace-events', current + missing)
+    except redis.exceptions.RedisError as e:
+        print(f"Warning: could not enable Redis keyspace notifications: {e}")
+        return False
+    return True
@@ -1,98 +1,207 @@
 import os
+import pickle
 import shutil
+import signal
 import subprocess
 import tempfile
 import time
-import uuid
-from concurrent.futures import ThreadPoolExecutor
 
 import redis
 import socketio
 
+import cpu_load
+import disk_io
+from progress import ProgressEmitter
+from redis_clients import make_cancel_client
+
 # --- Configuration (from your existing file) ---
 REDIS_URL = os.getenv("SOCKETIO_MESSAGE_QUEUE", "redis://redis:6379/0")
-redis_cancel_client = redis.StrictRedis(host='redis', port=6379, db=3, decode_responses=True)
+redis_cancel_client = make_cancel_client()
+
+
+
+class PipelinedEmitter:
+    """
+    Buffers Socket.IO emits from a write-only `socketio.RedisManager` and
+    publishes them in batches over a non-transactional Redis pipeline.
+
+    Messages use the same pickled payload `RedisManager` publishes on its
+    channel, so the Flask-SocketIO server cannot tell the difference. That
+    payload is python-socketio 5.11's private wire format (pinned in
+    requirements.txt); later releases no longer pickle, so revisit this
+    class when upgrading.
+
+    An emit is published at once when nothing was published in the last
+    `max_delay` seconds, so isolated events are not delayed. Emits that
+    follow closely are buffered and go out together once `max_batch` are
+    waiting or a later emit finds `max_delay` has passed. Nothing runs in
+    the background: call `flush()` to publish whatever is left, and always
+    before the task returns.
+    """
+
+    def __init__(self, manager, max_batch=8, max_delay=0.05):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Fields that never change between messages from this manager.
+        self._template = {
+            'method': 'emit',
+            'namespace': '/',
+            'skip_sid': None,
+            'callback': None,
+            'host_id': manager.host_id,
+        }
+        self._buffer = []
+        self._last_flush = 0.0
+
+    def emit(self, event, data, to=None):
+        message = dict(self._template, event=event, data=data, room=to)
+        self._buffer.append(pickle.dumps(message))
+        if (len(self._buffer) >= self.max_batch
+                or time.monotonic() - self._last_flush >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+        # Like RedisManager._publish, retry once on a fresh connection so a
+        # Redis blip does not lose e.g. task_finished. A batch that failed
+        # part way may then deliver some messages twice.
+        for retry in (False, True):
+            try:
+                if retry:
+                    self.manager._redis_connect()
+                pipe = self.manager.redis.pipeline(transaction=False)
+                for message in batch:
+                    pipe.publish(self.manager.channel, message)
+                pipe.execute()
+                return
+            except redis.exceptions.RedisError as e:
+                error = e
+        print(f"  [RQ Worker] Warning: Could not publish {len(batch)} Socket.IO message(s): {error}", flush=True)
+
+
+# One write-only manager per worker process, shared by every job it runs.
+# This relies on the worker running jobs in its own process (rq.SimpleWorker,
+# as in docker-compose); RQ's default forking Worker imports this module
+# afresh in each job's work horse, so nothing would be shared.
+worker_socketio = PipelinedEmitter(socketio.RedisManager(
+    REDIS_URL, write_only=True,
+    channel='flask-socketio'
+))
 
 
 def _run_subprocess(command):
-    """A helper function to run a command in a separate thread."""
+    """A helper function to run a command to completion."""
     # Use the standard library subprocess.run which blocks until the command is complete.
-    # capture_output=True prevents subprocess output from cluttering the worker logs.
-    result = subprocess.run(command, capture_output=True, check=False)
+    # Discarding output keeps it out of the worker logs without buffering it in memory.
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
     return result.returncode
 
 
+def _stop_process_group(proc):
+    """Kills `proc` and any workers it forked, e.g. `openssl speed -multi`."""
+    if proc is None or proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def _allocate_disk_file(fd):
+    """A helper function to preallocate the iteration's disk file."""
+    try:
+        return disk_io.allocate_file(fd)
+    except OSError as e:
+        print(f"  [RQ Worker] Warning: Could not allocate disk file: {e}", flush=True)
+        return f'error: {e}'
+
+
 def long_running_task(sid, total_iterations):
     """
-    An RQ task that runs concurrent CPU and Disk I/O bound subprocesses,
-    emits progress via RedisManager, and supports cancellation between iterations.
+    An RQ task that runs a CPU-bound subprocess for the whole task alongside
+    per-iteration Disk I/O, emits progress via RedisManager, and supports cancellation between iterations.
     """
 
     if total_iterations < 1:
         raise ValueError("total_iterations must be at least 1")
     
-    worker_socketio = socketio.RedisManager(
-        REDIS_URL, write_only=True,
-        channel='flask-socketio'
-    )
-
     worker_socketio.emit('task_started',
                          {'status': 'Your concurrent subprocess task has been started.'},
                          to=sid)
     print(f"[RQ Worker] Task started for SID: {sid}", flush=True)
 
-    cancel_key = f"cancel_{sid}"
+    cancel_key = f"cancel_{sid}".encode()
     temp_dir = tempfile.mkdtemp(prefix="rq-task-")
     print(f"  [RQ Worker] Created temp dir for SID {sid}: {temp_dir}", flush=True)
 
-    worker_socketio.emit('task_progress', {'percent': 0.0}, to=sid)
+    progress = ProgressEmitter(worker_socketio, sid)
+    progress.maybe_emit(0)
+    # The 0% event follows task_started closely enough to be buffered; don't
+    # hold it back until the first iteration ends.
+    worker_socketio.flush()
 
+    cpu_proc = None
     try:
+        # --- 1. Start the CPU Stage Once for the Whole Task ---
+        # A single long `openssl speed` run replaces one fork-heavy run per
+        # iteration; iterations are paced against its elapsed time instead.
+        # The new session lets us kill its forked workers along with it.
+        cpu_started = time.monotonic()
+        cpu_proc = subprocess.Popen(cpu_load.cpu_command(total_iterations),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                    start_new_session=True)
+
         for i in range(1, total_iterations + 1):
-            # --- 1. Pre-iteration Cancellation Check ---
-            if redis_cancel_client.get(cancel_key):
+            # --- 2. Pre-iteration Cancellation Check ---
+            if redis_cancel_client.exists(cancel_key):
                 print(f"  [!] Cancellation signal received for SID: {sid}. Stopping.", flush=True)
                 worker_socketio.emit('task_cancelled', {'status': 'Task was cancelled by user.'}, to=sid)
                 return  # Exit the task cleanly
 
             print(f"  [RQ Worker] Starting iteration {i}/{total_iterations} for SID: {sid}", flush=True)
 
-            # --- 2. Define Subprocess Commands ---
-            cpu_command = ["openssl", "speed", "-evp", "aes-256-cbc", "-multi", "10"]
-            disk_output_file = os.path.join(temp_dir, f"temp_disk_iter_{i}.bin")
-            disk_command = ["dd", "if=/dev/zero", f"of={disk_output_file}", "bs=1M", "count=1024", "oflag=direct"]
-
-            # --- 3. Run Concurrent Subprocesses using ThreadPoolExecutor ---
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                # Submit both commands to the thread pool to run concurrently
-                future_cpu = executor.submit(_run_subprocess, cpu_command)
-                future_disk = executor.submit(_run_subprocess, disk_command)
-
-                # .result() blocks until the future is complete, effectively waiting for both
-                cpu_exit_code = future_cpu.result()
-                disk_exit_code = future_disk.result()
-
-            print(f"  [RQ Worker] Finished iteration {i}. CPU exit: {cpu_exit_code}, Disk exit: {disk_exit_code}", flush=True)
-
-            # --- 4. Clean Up This Iteration's File ---
-            try:
-                os.remove(disk_output_file)
-            except OSError as e:
-                print(f"  [RQ Worker] Warning: Could not remove temp file {disk_output_file}: {e}", flush=True)
+            # --- 3. Run This Iteration's Disk Work ---
+            # The CPU stage runs on its own, so this no longer needs a thread.
+            # The disk file is anonymous and vanishes when closed.
+            with disk_io.scratch_file(temp_dir) as disk_fd:
+                if disk_io.USE_DD:
+                    disk_exit_code = _run_subprocess(disk_io.dd_command(disk_fd))
+                else:
+                    disk_exit_code = _allocate_disk_file(disk_fd)
+
+            # --- 4. Keep Pace with the CPU Stage ---
+            # Wait until the CPU stage has run for this iteration's share of
+            # time, unless it finishes early.
+            remaining = cpu_started + i * cpu_load.CPU_SECONDS_PER_ITERATION - time.monotonic()
+            if remaining > 0:
+                try:
+                    cpu_proc.wait(timeout=remaining)
+                except subprocess.TimeoutExpired:
+                    pass
+
+            print(f"  [RQ Worker] Finished iteration {i}. CPU exit: {cpu_proc.returncode}, Disk exit: {disk_exit_code}", flush=True)
 
             # --- 5. Report Progress ---
-            percent_complete = int((i / total_iterations) * 100)
-            worker_socketio.emit('task_progress', {'percent': percent_complete}, to=sid)
+            percent_complete = i * 100 // total_iterations
+            progress.maybe_emit(percent_complete)
             print(f"  [RQ Worker] ... progress {percent_complete}% for SID: {sid}", flush=True)
 
         # --- 6. Report Task Finished ---
         # If the loop finished without being cancelled, send the final 'finished' event.
-        if not redis_cancel_client.get(cancel_key):
+        if not redis_cancel_client.exists(cancel_key):
             worker_socketio.emit('task_finished', {'status': f'Task completed all {total_iterations} iterations.'}, to=sid)
             print(f"[RQ Worker] Task finished normally for SID: {sid}", flush=True)
 
     finally:
         # --- Final Cleanup ---
+        _stop_process_group(cpu_proc) # Don't leave openssl running past the task
         print(f"  [RQ Worker] Cleaning up temp dir: {temp_dir}", flush=True)
         shutil.rmtree(temp_dir, ignore_errors=True)
-        redis_cancel_client.delete(cancel_key) # Ensure the cancellation key is always removed
\ No newline at end of file
+        redis_cancel_client.delete(cancel_key) # Ensure the cancellation key is always removed
+        worker_socketio.flush() # Publish anything still buffered before the job ends
@@ -1,88 +1,409 @@
+import atexit
 import os
+import queue
 import sqlite3
-from contextlib import contextmanager
-from typing import Iterable, List, Optional
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 from models import Run
 
 _DB_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
 _DB_PATH = os.path.join(_DB_DIRECTORY, 'runs.db')
 
+# Do NOT add indexes on total_iterations or run_name. Every query is a
+# point lookup or an ordered scan on run_enum, which aliases the rowid, so
+# EXPLAIN QUERY PLAN shows "SEARCH runs USING INTEGER PRIMARY KEY" and a plain
+# "SCAN runs" with no sort step (tests/test_run_repository.py checks both).
+# A secondary index would only slow down create_run and update_*.
 _SCHEMA = """
 CREATE TABLE IF NOT EXISTS runs (
-    run_enum INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_enum INTEGER PRIMARY KEY,
     total_iterations INTEGER NOT NULL,
     run_name TEXT NOT NULL
 );
 """
 
+# Older databases declared run_enum AUTOINCREMENT, which makes every insert
+# also update sqlite_sequence. Runs are never deleted, so the plain rowid
+# alias hands out the same ascending ids. Loading the rows into _SCHEMA drops
+# it, and the first snapshot rewrites runs.db without it.
+_LOAD_ROW = "INSERT INTO runs (run_enum, total_iterations, run_name) VALUES (?, ?, ?)"
+
+# Statements are module constants so every call hands sqlite3 the same text,
+# which its per-connection statement cache keeps prepared. The connections
+# live for the whole process, so each statement is prepared once per
+# connection and then reused, which is the same effect as
+# SQLITE_PREPARE_PERSISTENT. The stdlib module does not expose that flag, and
+# the repository deliberately stays on stdlib sqlite3 rather than APSW.
+_SELECT_ALL = "SELECT run_enum, total_iterations, run_name FROM runs ORDER BY run_enum"
+_SELECT_ONE = "SELECT run_enum, total_iterations, run_name FROM runs WHERE run_enum = ?"
+_INSERT = "INSERT INTO runs (total_iterations, run_name) VALUES (?, ?)"
+# SQLite 3.35+ hands back the new id from the INSERT itself.
+_INSERT_RETURNING = _INSERT + " RETURNING run_enum"
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# Single-column updates skip rows that already hold the value, so a no-op
+# update writes nothing to the WAL.
+_UPDATE_ITERS = "UPDATE runs SET total_iterations = ? WHERE run_enum = ? AND total_iterations <> ?"
+_UPDATE_NAME = "UPDATE runs SET run_name = ? WHERE run_enum = ? AND run_name <> ?"
+_UPDATE_RUN = "UPDATE runs SET total_iterations = ?, run_name = ? WHERE run_enum = ?"
+
+_CACHED_STATEMENTS = 256
+
+# Per-connection settings; they do not persist in the database file. NORMAL
+# is durable enough under WAL and skips the fsync on every commit. Sent as
+# one script so a new connection is configured in a single call.
+_CONNECTION_SETUP = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+-- Both far exceed the size of the runs table, so with the long-lived
+-- connections it stays resident and reads never go back to pread().
+PRAGMA cache_size=-65536;  -- 64 MiB
+PRAGMA mmap_size=1073741824;  -- 1 GiB
+PRAGMA busy_timeout=3000;
+"""
+
+
+# Number of read-only connections serving list_runs/get_run.
+_READ_POOL_SIZE = 4
+
+# The authoritative copy of the runs table lives in an in-memory database on
+# the memdb VFS, so reads and writes never touch the disk. Unlike a
+# shared-cache database, memdb uses SQLite's normal file locking, so readers
+# only ever see committed data; they wait (busy_timeout) while a write
+# commits, and a write waits while a read is in progress. It is loaded from
+# runs.db on first use and copied back every _SNAPSHOT_INTERVAL seconds and at
+# exit, so a crash loses at most that many seconds of edits. This relies on a
+# single web process (gunicorn -w 1); the RQ worker never opens the DB.
+# The leading "/" makes every connection in the process open the same
+# database (SQLite 3.36+).
+_MEMORY_URI = "file:/runs?vfs=memdb"
+_SNAPSHOT_INTERVAL = float(os.getenv("RUNS_SNAPSHOT_INTERVAL", "30"))
+
+# runs.db checkpoints its WAL from a background timer instead of inside
+# whichever snapshot crosses the default 1000-page threshold; the raised
+# wal_autocheckpoint is only a backstop.
+_CHECKPOINT_INTERVAL = float(os.getenv("RUNS_CHECKPOINT_INTERVAL", "60"))
+
+# One long-lived writer connection for the process, so its page cache and
+# PRAGMAs survive between calls. It is in autocommit mode
+# (isolation_level=None) and shared across threads, with _write_lock
+# serialising its use and _disk_lock that of _DISK_CONN. Reads go to a pool
+# of read-only connections. _dirty is set by every committed write that
+# changes rows and cleared by a snapshot, so an unchanged store is not copied
+# to disk again. The pool and _exec / _executemany hold bound methods, so hot
+# paths skip the attribute lookups.
+_CONN: Optional[sqlite3.Connection] = None
+_DISK_CONN: Optional[sqlite3.Connection] = None
+_exec: Optional[Callable[..., sqlite3.Cursor]] = None
+_executemany: Optional[Callable[..., sqlite3.Cursor]] = None
+_write_lock = threading.Lock()
+_disk_lock = threading.Lock()
+_read_pool: Optional[queue.Queue] = None
+_dirty = False
+
+# The store is opened, loaded and migrated once per process, by whichever call
+# gets there first.
+_initialised = False
+_init_lock = threading.Lock()
+
+# Most recently used runs by run_enum, so repeat get_run() calls skip SQLite.
+# Writers update or drop entries; _cache_generation changes on every drop so a
+# read that raced with a write does not cache what it read.
+_RUN_CACHE_SIZE = 1024
+_run_cache: "OrderedDict[int, Run]" = OrderedDict()
+_run_cache_lock = threading.Lock()
+_cache_generation = 0
+
+
+def _cache_put(run: Run, generation: Optional[int] = None) -> None:
+    with _run_cache_lock:
+        if generation is not None and generation != _cache_generation:
+            return
+        _run_cache[run.run_enum] = run
+        _run_cache.move_to_end(run.run_enum)
+        if len(_run_cache) > _RUN_CACHE_SIZE:
+            _run_cache.popitem(last=False)
+
+
+def _cache_discard(run_enum: int) -> None:
+    global _cache_generation
+    with _run_cache_lock:
+        _cache_generation += 1
+        _run_cache.pop(run_enum, None)
+
 
 def _ensure_db_directory() -> None:
     os.makedirs(_DB_DIRECTORY, exist_ok=True)
 
 
-@contextmanager
-def _connection() -> Iterable[sqlite3.Connection]:
+def _configure(conn: sqlite3.Connection, extra_setup: str = "") -> sqlite3.Connection:
+    conn.executescript(_CONNECTION_SETUP + extra_setup)
+    return conn
+
+
+def _open_disk() -> sqlite3.Connection:
     _ensure_db_directory()
-    conn = sqlite3.connect(_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+    # The snapshot target; WAL keeps a snapshot from blocking on readers of
+    # the file (e.g. the sqlite3 shell) and is stored in the file itself.
+    return _configure(
+        sqlite3.connect(_DB_PATH, check_same_thread=False, isolation_level=None),
+        "PRAGMA journal_mode=WAL;\nPRAGMA wal_autocheckpoint=10000;",
+    )
+
+
+def _open_writer() -> sqlite3.Connection:
+    # Rows stay plain tuples here too; a caller that wants named access can
+    # set row_factory = sqlite3.Row on its own cursor.
+    return _configure(sqlite3.connect(
+        _MEMORY_URI, uri=True, check_same_thread=False, isolation_level=None,
+        cached_statements=_CACHED_STATEMENTS,
+    ))
+
+
+def _open_reader() -> sqlite3.Connection:
+    # Reads return plain tuples in SELECT column order, which is also the
+    # positional order of Run's fields.
+    return _configure(
+        sqlite3.connect(_MEMORY_URI, uri=True, check_same_thread=False, cached_statements=_CACHED_STATEMENTS),
+        "PRAGMA query_only=1;",
+    )
+
+
+def _open_store() -> None:
+    """Loads runs.db into the in-memory writer, migrates it and opens the read pool."""
+    global _CONN, _DISK_CONN, _exec, _executemany, _read_pool, _dirty
+    _DISK_CONN = _open_disk()
+    conn = _open_writer()
+    conn.executescript(_SCHEMA)
+    # A memdb database cannot open pages carrying runs.db's WAL header, so the
+    # rows are copied over instead of backing the file up page by page.
+    row = _DISK_CONN.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'runs'").fetchone()
+    if row is not None:
+        conn.execute("BEGIN")
+        conn.executemany(_LOAD_ROW, _DISK_CONN.execute(_SELECT_ALL))
+        conn.execute("COMMIT")
+    _dirty = row is None or 'AUTOINCREMENT' in row[0].upper()
+    _exec, _executemany = conn.execute, conn.executemany
+    _CONN = conn
+
+    # Readers attach to the in-memory database the writer keeps alive.
+    pool = queue.Queue(maxsize=_READ_POOL_SIZE)
+    for _ in range(_READ_POOL_SIZE):
+        pool.put(_open_reader().execute)
+    _read_pool = pool
+
+    atexit.register(_snapshot)
+    _run_periodically(_SNAPSHOT_INTERVAL, _snapshot, f"snapshot the runs database to {_DB_PATH}")
+    _run_periodically(_CHECKPOINT_INTERVAL, _checkpoint, f"checkpoint {_DB_PATH}")
+
+
+def _ensure_initialised() -> None:
+    global _initialised
+    if _initialised:
+        return
+    with _init_lock:
+        if not _initialised:
+            _open_store()
+            _initialised = True
+
+
+# The context managers below are plain classes rather than @contextmanager
+# generators, which every repository call would pay to create and drive.
+class _WriteConnection:
+    """Holds _write_lock and yields the writer connection; changing rows marks the store dirty."""
+
+    __slots__ = ("changes",)
+
+    def __enter__(self) -> sqlite3.Connection:
+        if not _initialised:
+            _ensure_initialised()
+        _write_lock.acquire()
+        self.changes = _CONN.total_changes
+        return _CONN
+
+    def __exit__(self, *exc_info) -> None:
+        global _dirty
+        # Failed writes and no-op or missing-row updates change nothing.
+        if _CONN.total_changes != self.changes:
+            _dirty = True
+        _write_lock.release()
+
+
+class _WriteTransaction(_WriteConnection):
+    """Runs a group of writes as one transaction, so they share one commit."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> sqlite3.Connection:
+        conn = super().__enter__()
+        try:
+            _exec("BEGIN IMMEDIATE")
+        except BaseException:
+            _write_lock.release()
+            raise
+        return conn
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        global _dirty
+        try:
+            if exc_type is not None:
+                _exec("ROLLBACK")
+            else:
+                try:
+                    _exec("COMMIT")
+                except BaseException:
+                    # A failed COMMIT (e.g. "database is locked" while a read
+                    # is in progress) leaves the transaction open, and the
+                    # next write would silently join it.
+                    _exec("ROLLBACK")
+                    raise
+                if _CONN.total_changes != self.changes:
+                    _dirty = True
+        finally:
+            _write_lock.release()
+
+
+class _ReadConnection:
+    """Checks out a read connection, yielding its bound `execute`."""
+
+    __slots__ = ("execute",)
+
+    def __enter__(self) -> Callable[..., sqlite3.Cursor]:
+        if not _initialised:
+            _ensure_initialised()
+        self.execute = _read_pool.get()
+        return self.execute
+
+    def __exit__(self, *exc_info) -> None:
+        _read_pool.put(self.execute)
+
+
+def _snapshot() -> None:
+    """Copies the in-memory database to runs.db if it changed since the last copy."""
+    global _dirty
+    with _write_lock, _disk_lock:
+        if not _dirty:
+            return
+        _CONN.backup(_DISK_CONN)
+        _dirty = False
+
+
+def _checkpoint() -> None:
+    """Moves runs.db's WAL into the main file without waiting on its readers."""
+    with _disk_lock:
+        _DISK_CONN.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+def _run_periodically(interval: float, task: Callable[[], None], description: str) -> None:
+    def run() -> None:
+        try:
+            task()
+        except sqlite3.Error as e:
+            print(f"Warning: could not {description}: {e}")
+        _run_periodically(interval, task, description)
+
+    timer = threading.Timer(interval, run)
+    timer.daemon = True
+    timer.start()
 
 
 def init_db() -> None:
-    with _connection() as conn:
-        conn.executescript(_SCHEMA)
-        conn.commit()
+    _ensure_initialised()
+    # Write a new or migrated schema straight back to runs.db.
+    _snapshot()
+
+
+def iter_runs() -> Iterator[Run]:
+    """Yields runs in run_enum order, streaming them from the cursor.
+
+    A read connection stays checked out until the generator is exhausted or
+    closed, so don't leave one suspended.
+    """
+    with _ReadConnection() as execute:
+        for row in execute(_SELECT_ALL):
+            yield Run._make(row)
 
 
 def list_runs() -> List[Run]:
-    with _connection() as conn:
-        rows = conn.execute(
-            "SELECT run_enum, total_iterations, run_name FROM runs ORDER BY run_enum"
-        ).fetchall()
-    return [Run(run_enum=row['run_enum'], total_iterations=row['total_iterations'], run_name=row['run_name']) for row in rows]
+    return list(iter_runs())
 
 
 def get_run(run_enum: int) -> Optional[Run]:
-    with _connection() as conn:
-        row = conn.execute(
-            "SELECT run_enum, total_iterations, run_name FROM runs WHERE run_enum = ?",
-            (run_enum,),
-        ).fetchone()
+    with _run_cache_lock:
+        run = _run_cache.get(run_enum)
+        if run is not None:
+            _run_cache.move_to_end(run_enum)
+            return run
+        generation = _cache_generation
+
+    with _ReadConnection() as execute:
+        row = execute(_SELECT_ONE, (run_enum,)).fetchone()
     if row is None:
         return None
-    return Run(run_enum=row['run_enum'], total_iterations=row['total_iterations'], run_name=row['run_name'])
+    run = Run._make(row)
+    _cache_put(run, generation)
+    return run
+
+
+def _insert(total_iterations: int, run_name: str) -> int:
+    """Inserts a run and returns its run_enum. Needs _write_lock."""
+    if _HAS_RETURNING:
+        # fetchall() steps the statement to completion so it is reset and
+        # its write commits right away.
+        return _exec(_INSERT_RETURNING, (total_iterations, run_name)).fetchall()[0][0]
+    return _exec(_INSERT, (total_iterations, run_name)).lastrowid
 
 
 def create_run(default_total_iterations: int = 50, default_run_name: str = "") -> Run:
-    with _connection() as conn:
-        cursor = conn.execute(
-            "INSERT INTO runs (total_iterations, run_name) VALUES (?, ?)",
-            (default_total_iterations, default_run_name),
-        )
-        conn.commit()
-        run_enum = cursor.lastrowid
-    return Run(run_enum=run_enum, total_iterations=default_total_iterations, run_name=default_run_name)
+    with _WriteConnection():
+        run_enum = _insert(default_total_iterations, default_run_name)
+    run = Run(run_enum=run_enum, total_iterations=default_total_iterations, run_name=default_run_name)
+    _cache_put(run)
+    return run
 
 
 def update_total_iterations(run_enum: int, total_iterations: int) -> bool:
-    with _connection() as conn:
-        cursor = conn.execute(
-            "UPDATE runs SET total_iterations = ? WHERE run_enum = ?",
-            (total_iterations, run_enum),
-        )
-        conn.commit()
-    return cursor.rowcount == 1
+    with _WriteConnection():
+        cursor = _exec(_UPDATE_ITERS, (total_iterations, run_enum, total_iterations))
+    if cursor.rowcount != 1:
+        # Either the run is missing or it already had this value.
+        return get_run(run_enum) is not None
+    _cache_discard(run_enum)
+    return True
 
 
 def update_run_name(run_enum: int, run_name: str) -> bool:
-    with _connection() as conn:
-        cursor = conn.execute(
-            "UPDATE runs SET run_name = ? WHERE run_enum = ?",
-            (run_name, run_enum),
-        )
-        conn.commit()
-    return cursor.rowcount == 1
+    with _WriteConnection():
+        cursor = _exec(_UPDATE_NAME, (run_name, run_enum, run_name))
+    if cursor.rowcount != 1:
+        # Either the run is missing or it already had this value.
+        return get_run(run_enum) is not None
+    _cache_discard(run_enum)
+    return True
+
+
+def create_runs_bulk(items: Iterable[Tuple[int, str]]) -> List[Run]:
+    """Creates a run for each (total_iterations, run_name) pair in one transaction."""
+    runs = []
+    with _WriteTransaction():
+        for total_iterations, run_name in items:
+            run_enum = _insert(total_iterations, run_name)
+            runs.append(Run(run_enum=run_enum, total_iterations=total_iterations, run_name=run_name))
+    for run in runs:
+        _cache_put(run)
+    return runs
+
+
+def update_many(runs: Iterable[Run]) -> int:
+    """Saves the iterations and name of each run in one transaction.
+
+    Returns the number of runs that existed and were updated.
+    """
+    runs = list(runs)
+    with _WriteTransaction():
+        # rowcount sums the rows changed by every parameter set.
+        cursor = _executemany(_UPDATE_RUN, [(run.total_iterations, run.run_name, run.run_enum) for run in runs])
+    for run in runs:
+        _cache_discard(run.run_enum)
+    return cursor.rowcount
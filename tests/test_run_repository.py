@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+import run_repository
+
+
+@pytest.fixture(scope="module")
+def repo(tmp_path_factory):
+    # The in-memory store is per process, so every test shares one, backed by
+    # a scratch runs.db rather than app/data/runs.db.
+    run_repository._DB_PATH = str(tmp_path_factory.mktemp("data") / "runs.db")
+    run_repository.init_db()
+    return run_repository
+
+
+def query_plan(conn, sql, params=()):
+    # SQLite before 3.24 says "SCAN TABLE runs" for the same plan.
+    return [row[3].replace("TABLE ", "") for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+@pytest.fixture
+def schema_only():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(run_repository._SCHEMA)
+    yield conn
+    conn.close()
+
+
+def test_list_scans_in_rowid_order_without_sorting(schema_only):
+    assert query_plan(schema_only, run_repository._SELECT_ALL) == ["SCAN runs"]
+
+
+def test_get_searches_by_rowid(schema_only):
+    assert query_plan(schema_only, run_repository._SELECT_ONE, (1,)) == [
+        "SEARCH runs USING INTEGER PRIMARY KEY (rowid=?)"
+    ]
+
+
+def test_updates_report_whether_the_run_exists(repo):
+    run = repo.create_run(3, "name")
+    missing = run.run_enum + 1000
+
+    assert repo.update_total_iterations(run.run_enum, 4)
+    assert repo.update_total_iterations(run.run_enum, 4)  # unchanged
+    assert not repo.update_total_iterations(missing, 4)
+    assert repo.update_run_name(run.run_enum, "renamed")
+    assert repo.update_run_name(run.run_enum, "renamed")  # unchanged
+    assert not repo.update_run_name(missing, "renamed")
+    assert repo.get_run(run.run_enum) == run._replace(total_iterations=4, run_name="renamed")
+    assert repo.get_run(missing) is None
+
+
+def test_failed_commit_rolls_back(repo):
+    # Two rows, since sqlite3 steps one row ahead and a cursor on its last
+    # row has already released its read.
+    repo.create_runs_bulk([(1, "a"), (2, "b")])
+    before = repo.list_runs()
+    busy_timeout = repo._CONN.execute("PRAGMA busy_timeout").fetchone()[0]
+    repo._CONN.execute("PRAGMA busy_timeout=50")
+    # A suspended iter_runs() keeps its read open, so COMMIT cannot finish.
+    rows = repo.iter_runs()
+    next(rows)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            repo.create_runs_bulk([(5, "locked")])
+    finally:
+        rows.close()
+        repo._CONN.execute(f"PRAGMA busy_timeout={busy_timeout}")
+
+    assert not repo._CONN.in_transaction
+    run = repo.create_run(7, "after")
+    assert repo.list_runs() == before + [run]
+
+
+def test_only_committed_changes_mark_the_store_dirty(repo):
+    run = repo.create_run(3, "dirty")
+    repo._snapshot()
+    assert not repo._dirty
+
+    repo.update_run_name(run.run_enum, "dirty")
+    repo.update_total_iterations(run.run_enum + 1000, 4)
+    with pytest.raises(sqlite3.IntegrityError):
+        repo.create_run(None, "no iterations")
+    with pytest.raises(sqlite3.IntegrityError):
+        repo.create_runs_bulk([(5, "rolled back"), (None, "no iterations")])
+    assert not repo._dirty
+
+    repo.update_run_name(run.run_enum, "changed")
+    assert repo._dirty